@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
+import multiprocessing
 import re
 import os
 import sublime, sublime_plugin
 import sys
-
-from collections import Counter, defaultdict, deque
+import threading
+
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as PoolTimeoutError
+from heapq import heappop, heappush, nlargest
+from itertools import count
 from pprint import pformat, pprint
 from subprocess import Popen, PIPE
 from tempfile import mkdtemp, mkstemp
@@ -24,6 +31,22 @@ def _alt(*res):
     return r'(?:' + r'|'.join(res) + r')'
 
 
+# plugins are loaded from the main plugin thread
+_main_thread = threading.current_thread()
+
+
+# Records emitted while streaming, once the AST subtree of a function or of
+# a Doxygen comment block is complete
+FunctionRecord = namedtuple('FunctionRecord',
+                            'name filename line ret signature args doc')
+ParamRecord = namedtuple('ParamRecord', 'name signature')
+CommentRecord = namedtuple('CommentRecord', 'filename params')
+
+# Existing documentation of a function, see DocIndex
+FunctionDoc = namedtuple('FunctionDoc', 'brief params ret')
+ParamDoc = namedtuple('ParamDoc', 'name pos description')
+
+
 class Parser(object):
     """Parse clang-check AST dump to extract useful hints for Doxygen
     """
@@ -49,17 +72,38 @@ class Parser(object):
     LEFT_RE = _alt(DEF_RE + FULDEF_RE, NULL_RE)
     LINE_CRE = re.compile(DEPTH_RE + LEFT_RE + RIGHT_RE)
     RANGE_CRE = re.compile(RANGE_RE)
+    TOPLEVEL_CRE = re.compile(br'^(?:\x1b[^m]*m)*[|`]-')
 
     CMD_JSON_NAME = 'compile_commands.json'
 
-    def __init__(self, clang_check, build_path, debug=False):
+    # below this count of AST lines, a process pool costs more than it saves
+    PARALLEL_MIN_LINES = 200000
+    # slowest expected parsing rate of the process pool, in lines per second;
+    # workers that have not completed in time are deemed stuck
+    PARALLEL_MIN_RATE = 20000
+    # split the dump into more chunks than workers to balance the load
+    CHUNKS_PER_JOB = 4
+
+    def __init__(self, clang_check, build_path, debug=False, jobs=1,
+                 stream=False, docindex=None, extra_args=None):
         self._debug = debug
+        self._jobs = jobs
+        self._stream = stream
+        self._listeners = []
         self._mainfile = None
         self._files = {}
         self._root = {}
         self._clang_check = clang_check
         self._build_path = build_path
+        self._extra_args = list(extra_args or [])
         self._parameters = {}
+        self._completions = None
+        self._comments = []
+        self._functions = []
+        # may be shared with other parsers, see DocIndex
+        self.docindex = DocIndex() if docindex is None else docindex
+        if stream:
+            self.subscribe(self._index_record)
 
     def parse(self, filename, cmddir):
         with self._exec_clang_check(filename, cmddir) as fp:
@@ -71,20 +115,25 @@ class Parser(object):
     def parse_buffer(self, srcname, buf):
         dname = mkdtemp()
         cmdname = os.path.join(dname, self.CMD_JSON_NAME)
+        fname = None
         try:
-            fname = os.path.join(os.path.dirname(srcname),
-                                 '.%s' % os.path.basename(srcname))
-            self._build_cmd_file(cmdname, srcname, fname)
-            with open(fname, 'wt') as fp:
+            # a file may be parsed both in the background and interactively,
+            # each parse uses its own copy of the buffer
+            stem, ext = os.path.splitext(os.path.basename(srcname))
+            fd, fname = mkstemp(suffix=ext, prefix='.%s.' % stem,
+                                dir=os.path.dirname(srcname))
+            with os.fdopen(fd, 'wt') as fp:
                 fp.write(buf)
+            self._build_cmd_file(cmdname, srcname, fname)
             self.parse(fname, dname)
         finally:
+            if fname:
+                os.unlink(fname)
             try:
                 # may have not been actually created
-                os.unlink(fname)
-            except:
+                os.unlink(cmdname)
+            except OSError:
                 pass
-            os.unlink(cmdname)
             os.rmdir(dname)
 
     def get_func(self, line):
@@ -99,9 +148,36 @@ class Parser(object):
         except AttributeError:
             return None
 
+    def subscribe(self, listener):
+        """Register a callable to receive the records emitted while streaming
+        """
+        self._listeners.append(listener)
+
     def build_tree(self, fp, show_tree=False):
+        if self._stream:
+            # subtrees are released as soon as they are complete, the tree
+            # is never kept alive
+            self._build_stack(fp, '', show_tree)
+            self._root = {}
+            return
+        if self._jobs > 1 and not show_tree:
+            lines = fp.readlines()
+            if len(lines) >= self.PARALLEL_MIN_LINES and \
+               self._build_tree_parallel(lines):
+                return
+            fp = lines
+        stack, filename, broken = self._build_stack(fp, '', show_tree)
+        # stack[0].dump(0)
+        self._root = stack[0]
+        self._index_docs()
+
+    def _build_stack(self, fp, filename, show_tree=False):
+        """Build the object tree from AST lines, returning the stack of the
+           deepest objects, the last seen file name and whether the parsing
+           has been aborted"""
         stack = deque()
-        filename = ''
+        broken = False
+        stream = self._stream
         for n, l, m, d in self._get_next_line(fp):
             filename = self._extract_filename(m, filename)
             stmt = m.group('stmt')
@@ -128,35 +204,122 @@ class Parser(object):
                 # create a child
                 if move > 1:
                     print("ERROR: too deep")
+                    broken = True
                     break
             else:
                 # want to retrieve the parent
                 while move < 0:
-                    stack.pop()
+                    closed = stack.pop()
+                    if stream:
+                        self._emit(closed.close())
                     move += 1
                 # we want to be a sibling, so get our parent, and 
                 # add a new child
-                stack.pop()
+                closed = stack.pop()
+                if stream:
+                    self._emit(closed.close())
             # the parent of the child is the deepest element on the stack
             parent = stack[-1]
-            parent.add_child(obj)
+            if not stream or parent.retains(obj):
+                parent.add_child(obj)
             # the new deepest element of the stack is now the new child
             stack.append(obj)
             if show_tree:
                 print("-------------- B:%s Child:%s" % (parent, obj))
-        # stack[0].dump(0)
-        self._root = stack[0]
+        if stream:
+            while stack:
+                self._emit(stack.pop().close())
+        return stack, filename, broken
+
+    def _build_tree_parallel(self, lines):
+        """Parse top-level subtrees of the AST dump in a process pool, then
+           stitch them back together in dump order.
+
+           The resulting functions and parameter documentation are the same
+           as the ones built by the serial parser."""
+        head, chunks = self._split_dump(lines,
+                                        self._jobs * self.CHUNKS_PER_JOB)
+        if len(chunks) < 2:
+            return False
+        stack, filename, broken = self._build_stack(head, '')
+        if not stack:
+            return False
+        pool = self._create_pool(self._jobs)
+        if not pool:
+            return False
+        args = [(head, chunk, self._debug) for chunk in chunks]
+        timeout = 5 + len(lines) / self.PARALLEL_MIN_RATE
+        try:
+            results = list(pool.map(_parse_chunk, args, timeout=timeout))
+        except Exception as e:
+            # a forked worker may be stuck on a lock held by another thread
+            # of the host: do not wait for the workers, and fall back to the
+            # serial parser
+            if isinstance(e, PoolTimeoutError):
+                e = 'timeout'
+            print("Cannot parse in parallel: %s" % e, file=sys.stderr)
+            processes = getattr(pool, '_processes', None) or {}
+            for process in list(processes.values()):
+                try:
+                    process.terminate()
+                except Exception:
+                    pass
+            pool.shutdown(wait=False)
+            return False
+        pool.shutdown()
+        comments = []
+        for files, ccomments, docs, last, broken in results:
+            # objects that precede the first location of a chunk belong
+            # to the last file seen in the previous chunks
+            for name, container in files.items():
+                if name is None:
+                    container.rename(filename)
+                    name = filename
+                if name not in self._files:
+                    self._files[name] = FileContainer(name)
+                self._files[name].update(container)
+            for fname, fsig, fdoc in docs:
+                self.docindex.add(fname, fsig, fdoc)
+            comments.extend((cfile is None and filename or cfile, params)
+                            for cfile, params in ccomments)
+            if last is not None:
+                filename = last
+            if broken:
+                break
+        # the tree itself is not gathered from the workers, only the
+        # parameter documentation it would provide
+        self._root = {}
+        self._comments = comments
+        return True
 
     def register_function(self, clobj, filename):
+        if self._stream:
+            # functions are registered once complete, see _index_record()
+            return
         if filename not in self._files:
             self._files[filename] = FileContainer(filename)
         self._files[filename].add_function(clobj)
+        self._functions.append(clobj)
 
     def collect_parameters(self, all=False, filename=None):
+        return self._reduce_parameters(
+            self._collect_all_parameters(all, filename))
+
+    def _collect_all_parameters(self, all, filename):
         if not all and not filename:
             filename = self._mainfile.name
-        parameters = self._root.collect_parameters(filename)
-        return self._reduce_parameters(parameters)
+        if self._root:
+            return self._root.collect_parameters(filename)
+        return self._collect_comment_parameters(filename)
+
+    def _collect_comment_parameters(self, filename):
+        parameters = {}
+        for cfile, cparams in self._comments:
+            if filename is not None and cfile != filename:
+                continue
+            for k in cparams:
+                parameters.setdefault(k, []).append(cparams[k])
+        return parameters
 
     @property
     def parameters(self):
@@ -164,6 +327,33 @@ class Parser(object):
             self._parameters = self.collect_parameters()
         return self._parameters
 
+    @property
+    def completions(self):
+        """Completion index over the parameters documented in all files"""
+        if self._completions is None:
+            self._completions = CompletionIndex(
+                self._collect_all_parameters(True, None))
+        return self._completions
+
+    def _emit(self, record):
+        if record is None:
+            return
+        for listener in self._listeners:
+            listener(record)
+
+    def _index_record(self, record):
+        if isinstance(record, FunctionRecord):
+            if record.filename not in self._files:
+                self._files[record.filename] = FileContainer(record.filename)
+            self._files[record.filename].add_function(record)
+            self.docindex.add(record.name, record.signature, record.doc)
+        elif isinstance(record, CommentRecord):
+            self._comments.append(record)
+
+    def _index_docs(self):
+        for clfunc in self._functions:
+            self.docindex.add(clfunc.name, clfunc.signature, clfunc.doc)
+
     def _get_next_line(self, fp):
         for n, l in enumerate(fp, start=1):
             # Python3, a byte stream is received but we need to handle strings
@@ -188,7 +378,9 @@ class Parser(object):
             yield n, l, mo, depth
 
     def _exec_clang_check(self, filename, cmddir):
-        args = [self._clang_check, '--ast-dump', '-p', cmddir, filename]
+        args = [self._clang_check, '--ast-dump']
+        args.extend('--extra-arg=%s' % arg for arg in self._extra_args)
+        args.extend(('-p', cmddir, filename))
         if self._debug:
             print(' '.join(args))
         return Popen(args, stdout=PIPE, stderr=PIPE, bufsize=-1).stdout
@@ -234,6 +426,53 @@ class Parser(object):
         with open(jsondst, 'wt') as json:
             json.write(newdata)
 
+    @staticmethod
+    def _create_pool(jobs):
+        """Create a process pool whose workers are forked from the current
+           process, or None if fork is not available.
+
+           Spawned workers would not work from the plugin host, which is not
+           a Python interpreter and provides the sublime module. Only the
+           main plugin thread forks, background threads would increase the
+           odds of forking while another thread holds a lock.
+        """
+        if not hasattr(os, 'fork'):
+            return None
+        if threading.current_thread() is not _main_thread:
+            return None
+        try:
+            if multiprocessing.cpu_count() < 2:
+                return None
+        except NotImplementedError:
+            return None
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            # Python 3.3 always forks on POSIX hosts
+            return ProcessPoolExecutor(jobs)
+        try:
+            return ProcessPoolExecutor(jobs, mp_context=context)
+        except TypeError:
+            # before Python 3.7, which still forks by default on POSIX hosts
+            return ProcessPoolExecutor(jobs)
+
+    @classmethod
+    def _split_dump(cls, lines, count):
+        """Split an AST dump on top-level declaration boundaries, into a
+           header and at most count chunks of similar sizes"""
+        marks = [n for n, l in enumerate(lines) if cls.TOPLEVEL_CRE.match(l)]
+        if not marks:
+            return lines, []
+        size = max(1, (len(lines)-marks[0]) // count)
+        chunks = []
+        start = marks[0]
+        for mark in marks[1:]:
+            if mark-start >= size:
+                chunks.append(lines[start:mark])
+                start = mark
+        chunks.append(lines[start:])
+        return lines[:marks[0]], chunks
+
     @classmethod
     def _extract_filename(cls, mo, default):
         # Ugly heuristic, there should be a better way to find the exact
@@ -253,6 +492,93 @@ class Parser(object):
         return rparams
 
 
+def _parse_chunk(args):
+    """Process pool entry point: parse a slice of top-level AST subtrees"""
+    head, chunk, debug = args
+    parser = Parser(None, None, debug)
+    # the file of the leading objects is not known yet, use None as a marker
+    stack, filename, broken = parser._build_stack(head + chunk, None)
+    comments = [(c.filename, c.get_parameters())
+                for c in stack[0].collect_comments([])]
+    docs = [(f.name, f.signature, f.doc) for f in parser._functions]
+    for container in parser._files.values():
+        container.prune()
+    return parser._files, comments, docs, filename, broken
+
+
+class DocIndex(object):
+    """Existing documentation of functions, indexed by function name and
+       signature.
+
+       A function documented in a header file gets the same documentation
+       when its definition is documented in a source file. An index may be
+       shared by the parsers of all the files of a translation unit.
+    """
+
+    def __init__(self):
+        self._docs = {}
+
+    def add(self, name, signature, doc):
+        if doc:
+            self._docs[(name, signature)] = doc
+
+    def get(self, name, signature):
+        return self._docs.get((name, signature))
+
+    def __len__(self):
+        return len(self._docs)
+
+
+class CompletionIndex(object):
+    """Prefix-searchable index of documented parameters.
+
+       Parameter names and descriptions are kept sorted so that a prefix
+       maps to a contiguous slice, found with a binary search. Matches are
+       ranked by how many times they have been used to document a parameter.
+    """
+
+    def __init__(self, parameters):
+        self._names = sorted(k for k in parameters if parameters[k])
+        self._weights = {}
+        self._best = {}
+        self._descs = {}
+        for name in self._names:
+            counts = Counter(d for d in parameters[name] if d)
+            self._weights[name] = len(parameters[name])
+            self._best[name] = counts and counts.most_common(1)[0][0] or ''
+            # case insensitive search, keep the actual description
+            self._descs[name] = sorted((d.lower(), d, c)
+                                       for d, c in counts.items())
+        # the empty prefix matches every name, do not rank them on each query
+        self._ranked = sorted(self._names, key=lambda n: -self._weights[n])
+
+    def names(self, prefix, count):
+        """Find the most used parameter names that start with prefix
+
+           :return: a list of (name, most used description) tuples
+        """
+        if prefix:
+            lo = bisect_left(self._names, prefix)
+            hi = bisect_left(self._names, prefix + '\uffff', lo)
+            names = nlargest(count, self._names[lo:hi],
+                             key=self._weights.__getitem__)
+        else:
+            names = self._ranked[:count]
+        return [(n, self._best[n]) for n in names]
+
+    def descriptions(self, name, prefix, count):
+        """Find the most used descriptions of a parameter that start with
+           prefix"""
+        descs = self._descs.get(name)
+        if not descs:
+            return []
+        prefix = prefix.lower()
+        lo = bisect_left(descs, (prefix,))
+        hi = bisect_left(descs, (prefix + '\uffff',), lo)
+        return [d[1] for d in nlargest(count, descs[lo:hi],
+                                       key=lambda x: x[2])]
+
+
 class FileContainer(object):
     """Container for functions in a single source file
     """
@@ -266,6 +592,18 @@ class FileContainer(object):
     def add_function(self, clfunc):
         self._functions[clfunc.line] = clfunc
 
+    def update(self, container):
+        self._functions.update(container._functions)
+
+    def rename(self, name):
+        self.name = name
+        for clfunc in self._functions.values():
+            clfunc.filename = name
+
+    def prune(self):
+        for clfunc in self._functions.values():
+            clfunc.prune()
+
     def get_at_line(self, line):
         if line in self._functions:
             return self._functions[line]
@@ -312,6 +650,22 @@ class ClangObject(object):
             self._update_parameters(params, cparams)
         return params
 
+    def collect_comments(self, comments):
+        for c in self._children:
+            c.collect_comments(comments)
+        return comments
+
+    def retains(self, child):
+        """Tell whether a child should be kept while streaming"""
+        return False
+
+    def close(self):
+        """Called once the subtree is complete, while streaming.
+
+           :return: a record to emit, if any
+        """
+        return None
+
     def _dump_children(self, depth):
         for c in self._children:
             c.dump(depth)
@@ -326,6 +680,13 @@ class ClangObject(object):
             else:
                 params[k].append(descs)
 
+    def __getstate__(self):
+        # the parser is only required while the tree is built, do not drag
+        # a worker parser across process boundaries
+        state = self.__dict__.copy()
+        state['parser'] = None
+        return state
+
     def __str__(self):
         return '[%x]-%s' % (self.uid & ((1 << 24)-1), self.__class__.__name__)
 
@@ -361,6 +722,7 @@ class ClangFunctionDecl(ClangObject):
         super(ClangFunctionDecl, self).__init__(parser, mo, filename)
         self.name = ''
         self.line = 0
+        self.signature = ''
         right = mo.group('right')
         smo = self.SCRATCH_CRE.match(right)
         if smo:
@@ -383,13 +745,40 @@ class ClangFunctionDecl(ClangObject):
             return
         self.name = fname
         self.line = line
-        self.ret = fmo.group('fsig').split('(')[0].strip()
+        self.signature = fmo.group('fsig')
+        self.ret = self.signature.split('(')[0].strip()
         self.parser.register_function(self, filename)
 
     @property
     def args(self):
         return [c for c in self._children if isinstance(c, ClangParmVarDecl)]
 
+    @property
+    def doc(self):
+        for c in self._children:
+            if isinstance(c, ClangFullComment):
+                doc = c.get_doc()
+                if doc:
+                    return doc
+        return None
+
+    def prune(self):
+        """Drop the children that are not required to document the function
+        """
+        self._children = self.args
+
+    def retains(self, child):
+        return isinstance(child, (ClangParmVarDecl, ClangFullComment))
+
+    def close(self):
+        if not self.line:
+            return None
+        return FunctionRecord(self.name, self.filename, self.line, self.ret,
+                              self.signature,
+                              tuple(ParamRecord(a.name, a.signature)
+                                    for a in self.args),
+                              self.doc)
+
     def __str__(self):
         return '%s: %s @ %s:%d' % (super(ClangFunctionDecl, self).__str__(),
                                    self.name, os.path.basename(self.filename),
@@ -421,6 +810,9 @@ class ClangParmVarDecl(ClangObject):
 class ClangFullComment(ClangObject):
     """A Doxygen comment block"""
 
+    BRIEF_COMMANDS = ('brief', 'short')
+    RETURN_COMMANDS = ('return', 'returns', 'result')
+
     def collect_parameters(self, filename):
         if filename is not None:
             if self.filename != filename:
@@ -429,6 +821,16 @@ class ClangFullComment(ClangObject):
         self._update_parameters(params, self.get_parameters())
         return params
 
+    def collect_comments(self, comments):
+        comments.append(self)
+        return comments
+
+    def retains(self, child):
+        return True
+
+    def close(self):
+        return CommentRecord(self.filename, self.get_parameters())
+
     def get_parameters(self):
         parameters = {}
         for c in self._children:
@@ -436,10 +838,38 @@ class ClangFullComment(ClangObject):
                 parameters[c.name] = c.description
         return parameters
 
+    def get_doc(self):
+        """Extract the function documentation from the comment block
+
+           :return: a FunctionDoc, or None if the block is empty
+        """
+        brief = ''
+        ret = ''
+        params = []
+        for c in self._children:
+            if isinstance(c, ClangParamCommandComment):
+                params.append(ParamDoc(c.name, c.pos, c.description))
+            elif isinstance(c, ClangBlockCommandComment):
+                if c.name in self.BRIEF_COMMANDS and not brief:
+                    brief = c.text
+                elif c.name in self.RETURN_COMMANDS and not ret:
+                    ret = c.text
+            elif isinstance(c, ClangParagraphComment) and not brief:
+                try:
+                    brief = c.text.strip()
+                except ValueError:
+                    pass
+        if not (brief or ret or params):
+            return None
+        return FunctionDoc(brief, tuple(params), ret)
+
 
 class ClangParagraphComment(ClangObject):
     """A Doxygen comment paragraph"""
 
+    def retains(self, child):
+        return True
+
     @property
     def text(self):
         try:
@@ -481,6 +911,30 @@ class ClangInlineCommandComment(ClangObject):
         self.text = text.strip()
 
 
+class ClangBlockCommandComment(ClangObject):
+    """A Doxygen block command comment (@brief, @return)"""
+
+    CRE = re.compile(r'Name="(?P<name>\w+)"')
+
+    def __init__(self, parser, mo, filename):
+        super(ClangBlockCommandComment, self).__init__(parser, mo, filename)
+        bcmo = self.CRE.match(mo.group('right') or '')
+        self.name = bcmo and bcmo.group('name') or ''
+
+    def retains(self, child):
+        return True
+
+    @property
+    def text(self):
+        texts = []
+        for c in self._children:
+            try:
+                texts.append(c.text)
+            except (AttributeError, ValueError):
+                pass
+        return ' '.join(texts).strip()
+
+
 class ClangParamCommandComment(ClangObject):
     """A Doxygen-commented function parameter"""
 
@@ -504,6 +958,9 @@ class ClangParamCommandComment(ClangObject):
             self.pos = -1
         self.dir = pcmo.group('dir')
 
+    def retains(self, child):
+        return True
+
     @property
     def description(self):
         d = ' '.join([c.text for c in self._children])
@@ -520,27 +977,48 @@ class DoxygenFunction(object):
 
     BOOL_KIND_CRE = re.compile(r'\w+_(is|has)_\w+')
 
-    def __init__(self, clangfunc):
+    def __init__(self, clangfunc, docindex=None):
         self.cfunc = clangfunc
+        # prefill with the documentation of another declaration, if any
+        self.fdoc = docindex.get(clangfunc.name, clangfunc.signature) \
+            if docindex is not None else None
 
     def to_dox(self, start=0):
         doc = []
         func = self.cfunc
+        fdoc = self.fdoc
         doc.append("/**")
-        doc.append(" * %s" % func.name)
+        doc.append(" * %s" % (fdoc and fdoc.brief or func.name))
         doc.append(" *")
-        for arg in func.args:
+        for pos, arg in enumerate(func.args):
             sig = arg.signature
             if sig.endswith('*'):
                 argdir = sig.startswith('const ') and 'in' or 'in,out'
             else:
                 argdir = 'in'
-            doc.append(" * @param[%s] %s" % (argdir, arg.name))
+            line = " * @param[%s] %s" % (argdir, arg.name)
+            desc = self._get_param_doc(arg.name, pos)
+            if desc:
+                line = ' '.join((line, desc))
+            doc.append(line)
         if func.ret != 'void':
-            doc.append(" * @return %s" % self._get_default_return_doc())
+            ret = fdoc and fdoc.ret or self._get_default_return_doc()
+            doc.append(" * @return %s" % ret)
         doc.append(" */")
         return '\n'.join(doc)[start:]
 
+    def _get_param_doc(self, name, pos):
+        if not self.fdoc:
+            return ''
+        # parameters may be named differently in another declaration
+        for pdoc in self.fdoc.params:
+            if pdoc.name == name:
+                return pdoc.description
+        for pdoc in self.fdoc.params:
+            if pdoc.pos == pos:
+                return pdoc.description
+        return ''
+
     def _get_default_return_doc(self):
         func = self.cfunc
         if self.BOOL_KIND_CRE.match(func.name) and \
@@ -549,7 +1027,7 @@ class DoxygenFunction(object):
         if func.ret == 'int':
             return '@c OK or a negative POSIX error code on error'
         if func.ret.endswith('*'):
-            return 'an instance of %s' % cfunc.ret.rstrip(' *')
+            return 'an instance of %s' % func.ret.rstrip(' *')
         return ''
 
 
@@ -557,6 +1035,109 @@ class DoxygenFunction(object):
 # Sublime Text plugin commands
 # -----------------------------------------------------------------------------
 
+class DoxyclangSettings(object):
+    """Read-only snapshot of the plugin settings.
+
+       User settings may be overridden per project folder, from the
+       .sublime-project files of the open windows, either for all the
+       folders of a project::
+
+         "settings": {"doxyclang": {"clang_check": "/opt/llvm/bin/clang-check"}}
+
+       or for a single folder::
+
+         "folders": [{"path": "fw", "doxyclang": {"extra_args": ["-DFW"]}}]
+    """
+
+    NAME = 'Doxyclang.sublime-settings'
+    KEYS = ('enabled', 'clang_check', 'build_path', 'build_path_comp',
+            'build_path_up', 'build_path_down', 'extra_args', 'parse_jobs',
+            'stream_parse', 'prewarm_jobs', 'prewarm_delay',
+            'completion_count', 'debug')
+    # keys that may be overridden in a project file
+    FOLDER_KEYS = ('clang_check', 'build_path', 'build_path_comp',
+                   'build_path_up', 'build_path_down', 'extra_args')
+    # keys that select the build path of a file
+    BUILD_PATH_KEYS = ('build_path', 'build_path_comp', 'build_path_up',
+                       'build_path_down')
+    # keys that change the outcome of a parse
+    PARSER_KEYS = ('clang_check', 'extra_args', 'parse_jobs',
+                   'stream_parse') + BUILD_PATH_KEYS
+
+    def __init__(self, values=None, folders=None, projects=None):
+        self.__dict__['_values'] = dict(values or {})
+        self.__dict__['_folders'] = dict(folders or {})
+        self.__dict__['_projects'] = frozenset(projects or ())
+        # per folder snapshots, built on demand
+        self.__dict__['_merged'] = {}
+
+    @classmethod
+    def load(cls):
+        """Build a snapshot from the user settings and the open projects"""
+        settings = sublime.load_settings(cls.NAME)
+        values = dict((k, settings.get(k)) for k in cls.KEYS)
+        folders = {}
+        projects = []
+        for window in sublime.windows():
+            project = window.project_file_name()
+            if project:
+                projects.append(project)
+            data = window.project_data()
+            if not data:
+                continue
+            topdir = project and os.path.dirname(project) or ''
+            overrides = data.get('settings', {}).get('doxyclang', {})
+            for folder in data.get('folders', []):
+                fvalues = dict(overrides)
+                fvalues.update(folder.get('doxyclang', {}))
+                fvalues = dict((k, fvalues[k]) for k in fvalues
+                               if k in cls.FOLDER_KEYS)
+                if not fvalues:
+                    continue
+                if fvalues.get('build_path'):
+                    # relative paths are relative to the project, as folders
+                    fvalues['build_path'] = os.path.normpath(os.path.join(
+                        topdir, os.path.expanduser(fvalues['build_path'])))
+                path = os.path.expanduser(folder.get('path', ''))
+                path = os.path.normpath(os.path.join(topdir, path))
+                folders[path] = fvalues
+        return cls(values, folders, projects)
+
+    def knows_project(self, project):
+        return project in self._projects
+
+    def for_file(self, filename):
+        """Settings that apply to a file, with the overrides of the
+           innermost project folder that contains it"""
+        folder = None
+        for path in self._folders:
+            if (filename + os.sep).startswith(path.rstrip(os.sep) + os.sep):
+                if not folder or len(path) > len(folder):
+                    folder = path
+        if not folder:
+            return self
+        if folder not in self._merged:
+            values = dict(self._values)
+            values.update(self._folders[folder])
+            self._merged[folder] = DoxyclangSettings(values)
+        return self._merged[folder]
+
+    def differs(self, other, keys):
+        return any(self.get(k) != other.get(k) for k in keys)
+
+    def get(self, name, default=None):
+        value = self._values.get(name)
+        return default if value is None else value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._values.get(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are read-only')
+
+
 class DoxyclangContext(object):
     """Maintain context across calls, there should be a cleaner way to 
        implement this"""
@@ -566,32 +1147,230 @@ class DoxyclangContext(object):
         self.line = 0
         self.cp = None
         self.choice = -1
-        if self.build_path:
-            self.buildpaths = self.build_path
-        else:
-            self.buildpaths = {}
+        # documentation indexes, one per build path, see get_docindex()
+        self.docindexes = {}
+        self.docfiles = {}
+        # loaded once the plugin API is ready, see plugin_loaded()
+        self.settings = DoxyclangSettings()
+        # build paths found with the heuristic search
+        self.buildpaths = {}
 
     def get_build_path(self, filename):
-        if isinstance(self.buildpaths, str):
-            return self.buildpaths
+        build_path = self.settings.for_file(filename).build_path
+        if build_path:
+            return build_path
         return self.buildpaths.get(filename, None)
 
     def set_build_path(self, filename, path):
-        if isinstance(self.buildpaths, str):
-            return
         self.buildpaths[filename] = path
 
-    def _get_settings(self):
-        settings = sublime.load_settings("Doxyclang.sublime-settings")
-        return settings
+    def get_docindex(self, filename, build_path):
+        """Documentation index shared by the files of the translation units
+           of a build path"""
+        self.docfiles[filename] = build_path
+        if build_path not in self.docindexes:
+            self.docindexes[build_path] = DocIndex()
+        return self.docindexes[build_path]
+
+    def reload(self):
+        """Rebuild the settings snapshot, and drop the cached build paths,
+           documentation indexes and parsers of the files whose settings
+           have changed"""
+        global _scheduler
+        old = self.settings
+        new = DoxyclangSettings.load()
+        self.settings = new
+
+        def changed(filename, keys):
+            return old.for_file(filename).differs(new.for_file(filename), keys)
+
+        for filename in list(self.buildpaths):
+            if changed(filename, DoxyclangSettings.BUILD_PATH_KEYS):
+                del self.buildpaths[filename]
+        for filename in list(self.docfiles):
+            if changed(filename, DoxyclangSettings.PARSER_KEYS):
+                self.docindexes.pop(self.docfiles.pop(filename), None)
+        if self.filename and \
+           changed(self.filename, DoxyclangSettings.PARSER_KEYS):
+            self.cp = None
+            self.filename = ''
+            self.line = 0
+        _scheduler.invalidate(
+            lambda f: changed(f, DoxyclangSettings.PARSER_KEYS))
+        if new.debug:
+            print("Doxyclang settings reloaded")
 
     def __getattr__(self, name):
         if name.startswith('_'):
             return self.__getattribute__(name)
-        return self._get_settings().get(name)
+        return self.settings.get(name)
 
 _context = DoxyclangContext()
 
+
+class ParseScheduler(object):
+    """Parse C files in background threads, so that a parser is usually
+       ready by the time a comment block is opened.
+
+       Queued files are parsed by priority, the active view first. At most
+       a configurable count of clang-check processes run at once, and no
+       new background parse is started while an interactive one runs.
+    """
+
+    ACTIVE = 0
+    BACKGROUND = 1
+    CACHE_SIZE = 16
+    # seconds an interactive parse waits for a running background one
+    TAKE_TIMEOUT = 2.0
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = count()
+        self._queue = []  # heap of (priority, seq, filename)
+        self._pending = {}  # filename -> (priority, seq, text, parser)
+        self._running = {}  # filename -> text
+        self._cache = OrderedDict()  # filename -> (text, parser)
+        self._interactive = 0
+        self._workers = 0
+        # running parses whose result is obsolete
+        self._discarded = set()
+
+    def schedule(self, filename, text, parser, priority, jobs):
+        """Queue a background parse of a file content"""
+        with self._cond:
+            cached = self._cache.get(filename)
+            if cached and cached[0] == text:
+                return
+            if self._running.get(filename) == text:
+                return
+            if priority == self.ACTIVE:
+                # only favour the last active view
+                for name, entry in list(self._pending.items()):
+                    if entry[0] == self.ACTIVE and name != filename:
+                        self._push(name, self.BACKGROUND, entry[2], entry[3])
+            self._push(filename, priority, text, parser)
+            if self._workers < jobs:
+                self._workers += 1
+                threading.Thread(target=self._work, daemon=True).start()
+            self._cond.notify()
+
+    def take(self, filename, text):
+        """Retrieve the parser of a file content, if already available.
+
+           A pending background parse of the file is cancelled. A running one
+           is waited for, at most TAKE_TIMEOUT seconds, if it parses the same
+           content; otherwise its result is discarded so that it does not
+           replace the one of the interactive parse.
+        """
+        with self._cond:
+            self._pending.pop(filename, None)
+            running = self._running.get(filename)
+            if running is not None:
+                if running != text or \
+                   not self._cond.wait_for(
+                        lambda: filename not in self._running,
+                        self.TAKE_TIMEOUT):
+                    self._discarded.add(filename)
+                    return None
+            cached = self._cache.get(filename)
+            if cached and cached[0] == text:
+                self._cache.move_to_end(filename)
+                return cached[1]
+            return None
+
+    def peek(self, filename):
+        """Retrieve the last parser of a file, whatever its content"""
+        with self._cond:
+            cached = self._cache.get(filename)
+            return cached[1] if cached else None
+
+    def store(self, filename, text, parser):
+        with self._cond:
+            self._cache[filename] = (text, parser)
+            self._cache.move_to_end(filename)
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """Forget the parsers and pending parses of the files that match
+           the predicate"""
+        with self._cond:
+            for filename in list(self._cache):
+                if predicate(filename):
+                    del self._cache[filename]
+            for filename in list(self._pending):
+                if predicate(filename):
+                    del self._pending[filename]
+            for filename in self._running:
+                if predicate(filename):
+                    self._discarded.add(filename)
+
+    def interactive(self):
+        """Context manager to wrap an interactive parse with"""
+        return _InteractiveParse(self)
+
+    def _push(self, filename, priority, text, parser):
+        seq = next(self._seq)
+        # superseded heap entries are skipped once popped, see _work()
+        self._pending[filename] = (priority, seq, text, parser)
+        heappush(self._queue, (priority, seq, filename))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._queue:
+                        self._workers -= 1
+                        return
+                    if self._interactive:
+                        self._cond.wait()
+                        continue
+                    priority, seq, filename = heappop(self._queue)
+                    entry = self._pending.get(filename)
+                    # a pending parse of a file being parsed stays pending,
+                    # it is queued again once the running parse completes
+                    if entry and entry[1] == seq and \
+                       filename not in self._running:
+                        break
+                del self._pending[filename]
+                text, parser = entry[2], entry[3]
+                self._running[filename] = text
+            try:
+                parser.parse_buffer(filename, text)
+                # do not leave the index to be built from the UI thread
+                parser.completions
+            except Exception as e:
+                parser = None
+                print("Cannot parse %s: %s" % (filename, e), file=sys.stderr)
+            with self._cond:
+                del self._running[filename]
+                if filename in self._discarded:
+                    self._discarded.discard(filename)
+                elif parser:
+                    self.store(filename, text, parser)
+                entry = self._pending.get(filename)
+                if entry:
+                    self._push(filename, entry[0], entry[2], entry[3])
+                self._cond.notify_all()
+
+
+class _InteractiveParse(object):
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+
+    def __enter__(self):
+        with self._scheduler._cond:
+            self._scheduler._interactive += 1
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with self._scheduler._cond:
+            self._scheduler._interactive -= 1
+            self._scheduler._cond.notify_all()
+
+_scheduler = ParseScheduler()
+
+
 class DoxyclangCommand(sublime_plugin.TextCommand):
 
     RE = r'^\s*(?:(?P<start>\/\*{2})$|' + \
@@ -625,26 +1404,18 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
             # a whole file if the very same comment block is being edited
             # check start/end lines of the comment block, and detect if it is
             # worth spawning a new parser at it.
-            build_path = _context.get_build_path(filename)
-            if not build_path:
-                build_path = self._find_build_command_dir(
-                    _context.build_path_comp, Parser.CMD_JSON_NAME,
-                    int(_context.build_path_up), int(_context.build_path_down),
-                    _context.debug)
-                if _context.debug:
-                    print("Build path for %s is %s" % (filename, build_path))
-                if build_path:
-                    _context.set_build_path(filename, build_path)
-            if not build_path:
-                print("Cannot find clang build path", file=sys.stderr)
-                return
-            clang_check = _context.clang_check
-            if not os.path.isfile(clang_check):
-                print("Invalid clang-check tool %s" % clang_check,
-                      file=sys.stderr)
-                return
-            cp = Parser(clang_check, build_path, _context.debug)
-            cp.parse_buffer(filename, buf)
+            # the file may have already been parsed in the background
+            # no background parse should start until the file is parsed
+            with _scheduler.interactive():
+                cp = _scheduler.take(filename, buf)
+                if not cp:
+                    cp = self.create_parser(self.view, filename)
+                    if not cp:
+                        return
+                    cp.parse_buffer(filename, buf)
+                    _scheduler.store(filename, buf, cp)
+                    # build the completion index ahead of the next @param
+                    sublime.set_timeout_async(lambda: cp.completions, 0)
             _context.cp = cp
             _context.line = line
             _context.filename = filename
@@ -653,7 +1424,7 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
         if mo.group('start'):
             func = cp.get_func(line)
             if func:
-                doc = DoxygenFunction(func).to_dox(len(linestr))
+                doc = DoxygenFunction(func, cp.docindex).to_dox(len(linestr))
                 self.view.insert(edit, point, doc)
             else:
                 self.view.insert(edit, point, '\n *\n */')
@@ -674,6 +1445,48 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
             region = self.view.line(point)
             self.view.replace(edit, region, newline)
 
+    @classmethod
+    def create_parser(cls, view, filename, verbose=True):
+        """Create a parser for a file of a view, or None if clang-check cannot
+           be run on it"""
+        global _context
+        settings = _context.settings.for_file(filename)
+        build_path = _context.get_build_path(filename)
+        if not build_path:
+            window = view.window()
+            folder = window and window.extract_variables().get('folder')
+            if not folder:
+                return None
+            build_path = cls._find_build_command_dir(
+                folder,
+                settings.build_path_comp, Parser.CMD_JSON_NAME,
+                int(settings.build_path_up), int(settings.build_path_down),
+                _context.debug)
+            if _context.debug:
+                print("Build path for %s is %s" % (filename, build_path))
+            if build_path:
+                _context.set_build_path(filename, build_path)
+        if not build_path:
+            if verbose:
+                print("Cannot find clang build path", file=sys.stderr)
+            return None
+        clang_check = settings.clang_check
+        if not os.path.isfile(clang_check):
+            if verbose:
+                print("Invalid clang-check tool %s" % clang_check,
+                      file=sys.stderr)
+            return None
+        jobs = int(settings.parse_jobs or 0)
+        if jobs < 1:
+            try:
+                jobs = multiprocessing.cpu_count()
+            except NotImplementedError:
+                jobs = 1
+        return Parser(clang_check, build_path, _context.debug, jobs,
+                      bool(settings.stream_parse),
+                      _context.get_docindex(filename, build_path),
+                      settings.extra_args)
+
     @staticmethod
     def enumerate_dir_candidates(topdir, dircomp, depth):
         """Find all directories whose last component matches"""
@@ -719,9 +1532,10 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
                                                        self.view.size()))
         return ''.join((before_insert, after_insert))
 
-    def _find_build_command_dir(self, dircomp, bldfile, maxup, maxdown, debug):
+    @classmethod
+    def _find_build_command_dir(cls, folder, dircomp, bldfile, maxup, maxdown,
+                                debug):
         # start from the current ST folder
-        folder = self.view.window().extract_variables()['folder']
         current = folder
 
         if debug:
@@ -740,7 +1554,9 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
 
         # get all directories that contains the specified dircomp
         dcompref = [(d, len(os.path.commonprefix((folder, d)))) for d in
-                    self.enumerate_dir_candidates(current, dircomp, maxdown)]
+                    cls.enumerate_dir_candidates(current, dircomp, maxdown)]
+        if not dcompref:
+            return None
         # select the one that closely looks like the original folder, so
         # that candidates for other build component are not considered
         dbest = sorted(dcompref, key=lambda x: -x[1])[0][0]
@@ -752,7 +1568,7 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
             print("bld: dbest %s" % dbest)
 
         # find all clang build files within the selected directory
-        dref = list(self.enumerate_file_candidates(dbest, bldfile, maxdown))
+        dref = list(cls.enumerate_file_candidates(dbest, bldfile, maxdown))
         if not dref:
             return None
 
@@ -760,7 +1576,7 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
             print("bld: dref %s" % dref)
 
         # remove common part from candidates
-        common = self.common_path(dref)
+        common = cls.common_path(dref)
         cmnlen = len(common)
         dist = ['%s' % d[cmnlen:] for d in dref]
 
@@ -787,6 +1603,154 @@ class DoxyclangCommand(sublime_plugin.TextCommand):
         return best
 
 
+class DoxyclangSettingsListener(sublime_plugin.EventListener):
+    """Reload the settings when a project file changes"""
+
+    def on_post_save_async(self, view):
+        global _context
+        if (view.file_name() or '').endswith('.sublime-project'):
+            _context.reload()
+
+    def on_load_project_async(self, window):
+        global _context
+        _context.reload()
+
+    def on_activated_async(self, view):
+        global _context
+        # Sublime Text 3 does not notify project loading
+        window = view.window()
+        project = window and window.project_file_name()
+        if project and not _context.settings.knows_project(project):
+            _context.reload()
+
+
+class DoxyclangPrewarmListener(sublime_plugin.EventListener):
+    """Parse C files in the background when they are loaded, focused or
+       left idle after a modification"""
+
+    def on_load_async(self, view):
+        self._schedule(view, ParseScheduler.BACKGROUND)
+
+    def on_activated_async(self, view):
+        self._schedule(view, ParseScheduler.ACTIVE)
+
+    def on_modified_async(self, view):
+        global _context
+        delay = int(_context.prewarm_delay or 0)
+        if delay < 1 or not bool(_context.enabled):
+            return
+        change = view.change_count()
+        sublime.set_timeout_async(lambda: self._on_idle(view, change), delay)
+
+    def _on_idle(self, view, change):
+        # only the last modification of a typing burst triggers a parse
+        if not view.is_valid() or view.change_count() != change:
+            return
+        self._schedule(view, ParseScheduler.ACTIVE)
+
+    def _schedule(self, view, priority):
+        global _context
+        if not bool(_context.enabled):
+            return
+        jobs = int(_context.prewarm_jobs or 0)
+        if jobs < 1:
+            return
+        filename = view.file_name()
+        if not filename or view.is_loading():
+            return
+        if os.path.splitext(filename)[1] not in ('.c', '.h'):
+            return
+        parser = DoxyclangCommand.create_parser(view, filename, False)
+        if not parser:
+            return
+        text = view.substr(sublime.Region(0, view.size()))
+        _scheduler.schedule(filename, text, parser, priority, jobs)
+
+
+class DoxyclangCompletionListener(sublime_plugin.EventListener):
+    """Complete the parameter names and descriptions of @param lines"""
+
+    RE = r'^\s*\*\s+@param(?:\[(?:in|out|in,out)\])?\s+' + \
+         r'(?:(?P<arg>\w+)\s+)?(?P<desc>.*)$'
+    CRE = re.compile(RE)
+
+    def on_modified(self, view):
+        global _context
+        if not bool(_context.enabled):
+            return
+        # the default auto_complete_selector excludes comments, the
+        # completion popup is requested explicitly
+        sel = view.sel()
+        if len(sel) != 1 or not sel[0].empty():
+            return
+        if view.is_auto_complete_visible():
+            return
+        # the typed word only matters to the completion contents
+        if not self._complete(view, '', sel[0].begin()):
+            return
+        view.run_command('auto_complete', {'disable_auto_insert': True,
+                                           'next_completion_if_showing': False})
+
+    def on_query_completions(self, view, prefix, locations):
+        global _context
+        if not bool(_context.enabled):
+            return None
+        completions = self._complete(view, prefix, locations[0])
+        if not completions:
+            return None
+        return (completions, sublime.INHIBIT_WORD_COMPLETIONS)
+
+    def _complete(self, view, prefix, point):
+        filename = view.file_name()
+        if not filename:
+            return None
+        linestr = view.substr(sublime.Region(view.line(point).begin(), point))
+        mo = self.CRE.match(linestr)
+        if not mo:
+            return None
+        # only complete from the parsers of the file being edited
+        if _context.cp and _context.filename == filename:
+            cp = _context.cp
+        else:
+            cp = _scheduler.peek(filename)
+        if not cp:
+            return None
+        count = int(_context.completion_count or 10)
+        index = cp.completions
+        arg = mo.group('arg')
+        completions = []
+        if not arg:
+            for name, desc in index.names(mo.group('desc'), count):
+                completions.append(['%s\t%s' % (name, desc),
+                                    self._escape(' '.join((name, desc))
+                                                 .rstrip())])
+        else:
+            typed = mo.group('desc')
+            # ST only replaces the word being typed
+            start = len(typed)-len(prefix)
+            for desc in index.descriptions(arg, typed, count):
+                completions.append(['%s\t@param %s' % (desc[start:], arg),
+                                    self._escape(desc[start:])])
+        return completions
+
+    @staticmethod
+    def _escape(text):
+        """Completion contents are snippets, escape their markers"""
+        return text.replace('\\', '\\\\').replace('$', '\\$')
+
+
+def plugin_loaded():
+    global _context
+    settings = sublime.load_settings(DoxyclangSettings.NAME)
+    settings.add_on_change('doxyclang', _context.reload)
+    _context.reload()
+
+
+def plugin_unloaded():
+    settings = sublime.load_settings(DoxyclangSettings.NAME)
+    settings.clear_on_change('doxyclang')
+
+
 #if __name__ == '__main__':
 #    dc = DoxyClang(False)
 #    for n, l, m, d in dc._get_next_line(sys.stdin): 